@@ -1,9 +1,29 @@
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
+import orjson
 import pickle
-import json
 import os
 from datetime import datetime
 from collections import defaultdict
+from functools import lru_cache
+import numpy as np
+import zstandard as zstd
+
+
+@lru_cache(maxsize=1)
+def _load_pickle(model_path, mtime):
+    """
+    Carrega o pickle do modelo, memoizado por (path, mtime)
+    
+    O mtime faz parte da chave: se o arquivo for reescrito, o cache não é usado.
+    Só o último modelo fica no cache, para o anterior ser liberado após um reload.
+    Modelos .zst são descomprimidos em streaming; os demais são pickle puro.
+    """
+    with open(model_path, 'rb') as f:
+        if model_path.endswith('.zst'):
+            with zstd.ZstdDecompressor().stream_reader(f) as reader:
+                return pickle.load(reader)
+        return pickle.load(f)
 
 
 class ModelLoader:
@@ -23,7 +43,7 @@ class ModelLoader:
         Passos:
         1. Ler metadata.json
         2. Identificar current_version
-        3. Carregar pickle do modelo correspondente
+        3. Carregar pickle do modelo correspondente (cache por path + mtime)
         4. Armazenar version e timestamp
         
         Returns:
@@ -38,8 +58,8 @@ class ModelLoader:
             raise FileNotFoundError("No metadata.json found. Train a model first.")
         
         # Ler metadata
-        with open(self.metadata_file, 'r') as f:
-            metadata = json.load(f)
+        with open(self.metadata_file, 'rb') as f:
+            metadata = orjson.loads(f.read())
         
         current_version = metadata.get('current_version', '0.0')
         
@@ -53,9 +73,8 @@ class ModelLoader:
         
         model_path = model_info['path']
         
-        # Carregar pickle
-        with open(model_path, 'rb') as f:
-            self.current_model = pickle.load(f)
+        # Carregar pickle (reaproveitado se o arquivo não mudou)
+        self.current_model = _load_pickle(model_path, os.stat(model_path).st_mtime)
         
         self.current_version = current_version
         self.model_date = model_info['timestamp']
@@ -84,6 +103,72 @@ class RecommendationEngine:
         """
         self.rules = model_data['rules']
         self.frequent_itemsets = model_data.get('frequent_itemsets', [])
+        self._build_index()
+    
+    def _build_index(self):
+        """
+        Pré-processa as regras uma única vez por modelo
+        
+        - vocabulary: nome normalizado -> índice da música
+        - song_indptr/song_rules: CSR música -> regras cujo antecedent a contém
+        - antecedent_len[r]: número de músicas distintas do antecedent
+        - song_names/consequent_ids: músicas candidatas (consequentes) <-> índice
+        - rule_indptr/rule_consequents: CSR regra -> músicas do consequent
+        - scores[r]: confidence * lift
+        """
+        self.vocabulary = {}
+        postings = []
+        antecedent_len = []
+        self.song_names = []
+        self.consequent_ids = {}
+        consequent_lists = []
+        scores = []
+        
+        # Cada "Song,Artist" aparece em muitas regras: extrair o nome uma vez só
+        self._song_name_cache = {}
+        song_names = self._song_names
+        
+        for idx, rule in enumerate(self.rules):
+            antecedent = {song_names(item)[1] for item in rule['antecedent']}
+            for song in antecedent:
+                song_id = self.vocabulary.setdefault(song, len(postings))
+                if song_id == len(postings):
+                    postings.append([])
+                postings[song_id].append(idx)
+            antecedent_len.append(len(antecedent))
+            
+            consequent = []
+            for item in rule['consequent']:
+                song_name = song_names(item)[0]
+                candidate_id = self.consequent_ids.setdefault(song_name, len(self.song_names))
+                if candidate_id == len(self.song_names):
+                    self.song_names.append(song_name)
+                consequent.append(candidate_id)
+            consequent_lists.append(consequent)
+            scores.append(rule['confidence'] * rule['lift'])
+        
+        self.song_indptr, self.song_rules = self._to_csr(postings)
+        self.antecedent_len = np.array(antecedent_len, dtype=np.int64)
+        self.rule_indptr, self.rule_consequents = self._to_csr(consequent_lists)
+        self.scores = np.array(scores, dtype=np.float64)
+        
+        # Nome normalizado de cada candidato (id em normalized_ids), para descartar
+        # os que já estão no input com uma máscara
+        self.normalized_ids = {}
+        self.candidate_names = np.array([
+            self.normalized_ids.setdefault(song_name.lower(), len(self.normalized_ids))
+            for song_name in self.song_names
+        ], dtype=np.int64)
+    
+    @staticmethod
+    def _to_csr(lists):
+        """Converte uma lista de listas de índices em (indptr, indices)"""
+        indptr = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum([len(values) for values in lists], out=indptr[1:])
+        indices = np.fromiter(
+            (value for values in lists for value in values), dtype=np.int32, count=indptr[-1]
+        )
+        return indptr, indices
     
     def recommend(self, input_songs, top_n=5):
         """
@@ -98,82 +183,83 @@ class RecommendationEngine:
             
         Algoritmo:
             1. Normalizar input_songs (lowercase, strip)
-            2. Para cada regra:
-               - Extrair nomes das músicas do antecedent (remover artista)
-               - Verificar se TODOS estão no input
-               - Se sim, calcular score = confidence * lift
-               - Adicionar consequentes aos candidatos
+            2. Contar, via índice invertido, quantas músicas de cada
+               antecedent estão no input
+               - A regra se aplica se a contagem == tamanho do antecedent
+               - Se sim, usar score = confidence * lift pré-calculado
+               - Score de cada candidato = máximo entre as regras (np.maximum.at)
             3. Remover músicas já presentes no input
             4. Ordenar por score e retornar top_n
         """
         # Normalizar input
-        input_normalized = [s.lower().strip() for s in input_songs]
-        
-        # Encontrar regras aplicáveis
-        candidates = {}  # {song_name: score}
-        
-        for rule in self.rules:
-            # Verificar se antecedente match com input
-            if self._matches_input(rule['antecedent'], input_normalized):
-                score = rule['confidence'] * rule['lift']
-                
-                # Adicionar consequentes
-                for consequent in rule['consequent']:
-                    song_name = self._extract_song_name(consequent)
-                    
-                    # Não recomendar músicas já no input
-                    if not self._is_in_input(song_name, input_normalized):
-                        if song_name in candidates:
-                            # Manter score máximo
-                            candidates[song_name] = max(candidates[song_name], score)
-                        else:
-                            candidates[song_name] = score
+        input_set = {s.lower().strip() for s in input_songs}
+        
+        # Encontrar regras aplicáveis: o antecedent está contido no input quando
+        # todas as suas músicas aparecem nas listas das músicas do input
+        song_ids = [self.vocabulary[s] for s in input_set if s in self.vocabulary]
+        if not song_ids:
+            return []
+        hits = np.concatenate([
+            self.song_rules[self.song_indptr[s]:self.song_indptr[s + 1]] for s in song_ids
+        ])
+        matched = np.bincount(hits, minlength=len(self.rules))
+        applicable = np.flatnonzero(matched == self.antecedent_len)
+        
+        # Consequentes das regras aplicáveis, com o score de cada regra
+        starts = self.rule_indptr[applicable]
+        lengths = self.rule_indptr[applicable + 1] - starts
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        candidate_ids = self.rule_consequents[offsets + np.arange(lengths.sum())]
+        candidate_scores = np.repeat(self.scores[applicable], lengths)
+        
+        # Score máximo por música; a primeira ocorrência desempata como antes
+        best = np.full(len(self.song_names), -np.inf)
+        np.maximum.at(best, candidate_ids, candidate_scores)
+        first_seen = np.full(len(self.song_names), len(candidate_ids))
+        np.minimum.at(first_seen, candidate_ids, np.arange(len(candidate_ids)))
+        
+        # Não recomendar músicas já no input
+        input_names = [self.normalized_ids[s] for s in input_set if s in self.normalized_ids]
+        np.putmask(best, np.isin(self.candidate_names, input_names), -np.inf)
         
         # Ordenar por score e retornar top_n
-        ranked = sorted(candidates.items(), key=lambda x: x[1], reverse=True)
-        return [song for song, score in ranked[:top_n]]
+        ranked = np.flatnonzero(best > -np.inf)
+        if 0 < top_n < len(ranked):
+            # Seleção O(n) do top_n-ésimo score; os empatados com ele também
+            # entram, para o desempate pela primeira ocorrência continuar valendo
+            kth = -np.partition(-best[ranked], top_n - 1)[top_n - 1]
+            ranked = ranked[best[ranked] >= kth]
+        ranked = ranked[np.lexsort((first_seen[ranked], -best[ranked]))]
+        return [self.song_names[i] for i in ranked[:top_n]]
     
-    def _extract_song_name(self, full_string):
+    def _song_names(self, full_string):
         """
-        Extrai nome da música de "Song Name,Artist Name"
+        Nome da música e nome normalizado, memoizados por string do modelo
         
         Args:
             full_string: "Yesterday,Beatles"
             
         Returns:
-            "Yesterday"
+            ("Yesterday", "yesterday")
         """
-        return full_string.split(',')[0].strip()
+        names = self._song_name_cache.get(full_string)
+        if names is None:
+            song_name = self._extract_song_name(full_string)
+            names = (song_name, song_name.lower())
+            self._song_name_cache[full_string] = names
+        return names
     
-    def _matches_input(self, antecedent, input_normalized):
-        """
-        Verifica se antecedente match com input
-        
-        Args:
-            antecedent: ["Yesterday,Beatles", "Hey Jude,Beatles"]
-            input_normalized: ["yesterday", "hey jude"]
-            
-        Returns:
-            True se TODOS os items do antecedent estão no input
-        """
-        for item in antecedent:
-            song_name = self._extract_song_name(item).lower().strip()
-            if song_name not in input_normalized:
-                return False
-        return True
-    
-    def _is_in_input(self, song_name, input_normalized):
+    def _extract_song_name(self, full_string):
         """
-        Verifica se música já está no input
+        Extrai nome da música de "Song Name,Artist Name"
         
         Args:
-            song_name: "Let It Be"
-            input_normalized: ["yesterday", "hey jude"]
+            full_string: "Yesterday,Beatles"
             
         Returns:
-            True se música está no input
+            "Yesterday"
         """
-        return song_name.lower().strip() in input_normalized
+        return full_string.partition(',')[0].strip()
 
 
 def validate_recommend_request(data):
@@ -207,12 +293,42 @@ def validate_recommend_request(data):
     return True, None
 
 
+class OrjsonProvider(JSONProvider):
+    """Serialização JSON do Flask (jsonify, request.get_json) via orjson"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# Limite de itens por POST /api/recommender/batch (cada lote ocupa um worker síncrono)
+MAX_BATCH_SIZE = 100
 model_loader = ModelLoader(models_dir='/app/models')
 
+# RecommendationEngine do modelo carregado, recriado só quando o modelo muda
+_engine = None
+_engine_model = None
+
+
+def get_engine():
+    """Retorna o RecommendationEngine do modelo atualmente carregado"""
+    global _engine, _engine_model
+    
+    model = model_loader.current_model
+    if _engine is None or _engine_model is not model:
+        _engine = RecommendationEngine(model)
+        _engine_model = model
+    return _engine
+
 # Carregar modelo na inicialização
 try:
     model_loader.load_latest_model()
+    get_engine()  # Índice montado antes do fork dos workers (gunicorn --preload)
     print(f"[INFO] Model loaded: version {model_loader.current_version}")
 except Exception as e:
     print(f"[WARNING] No model available: {e}")
@@ -269,7 +385,7 @@ def recommend():
         input_songs = data['songs']
         
         # Gerar recomendações
-        engine = RecommendationEngine(model_loader.current_model)
+        engine = get_engine()
         recommendations = engine.recommend(input_songs, top_n=5)
         
         # Formatar resposta
@@ -287,6 +403,82 @@ def recommend():
         }), 500
 
 
+@app.route('/api/recommender/batch', methods=['POST'])
+def recommend_batch():
+    """
+    Recomendações para várias listas de músicas em uma única requisição
+    
+    Request:
+    {
+        "requests": [
+            {"songs": ["Yesterday", "Bohemian Rhapsody"]},
+            {"songs": ["Hey Jude"]}
+        ]
+    }
+    
+    Response (Success):
+    {
+        "results": [
+            {"songs": ["Hey Jude", "Let It Be", "Come Together"]},
+            {"songs": ["Let It Be"]}
+        ],
+        "version": "1.0",
+        "model_date": "2025-11-09T20:00:00"
+    }
+    """
+    try:
+        # Verificar se modelo está carregado
+        if not model_loader.is_model_loaded():
+            return jsonify({
+                'error': 'No trained model available'
+            }), 503
+        
+        # Validar request
+        data = request.get_json()
+        if not isinstance(data, dict) or not isinstance(data.get('requests'), list) \
+                or not data['requests']:
+            return jsonify({
+                'error': "Campo 'requests' deve ser uma lista não vazia"
+            }), 400
+        
+        if len(data['requests']) > MAX_BATCH_SIZE:
+            return jsonify({
+                'error': f"'requests' aceita no máximo {MAX_BATCH_SIZE} itens"
+            }), 400
+        
+        for idx, item in enumerate(data['requests']):
+            if not isinstance(item, dict):
+                return jsonify({
+                    'error': f"requests[{idx}]: cada item deve ser um objeto"
+                }), 400
+            valid, error_msg = validate_recommend_request(item)
+            if not valid:
+                return jsonify({
+                    'error': f"requests[{idx}]: {error_msg}"
+                }), 400
+        
+        # Gerar recomendações (mesmo engine para todo o lote)
+        engine = get_engine()
+        results = [
+            {'songs': engine.recommend(item['songs'], top_n=5)}
+            for item in data['requests']
+        ]
+        
+        # Formatar resposta
+        model_info = model_loader.get_model_info()
+        
+        return jsonify({
+            'results': results,
+            'version': model_info['version'],
+            'model_date': model_info['model_date']
+        }), 200
+        
+    except Exception as e:
+        return jsonify({
+            'error': str(e)
+        }), 500
+
+
 @app.route('/reload-model', methods=['POST'])
 def reload_model():
     """
@@ -296,6 +488,7 @@ def reload_model():
     """
     try:
         model_loader.load_latest_model()
+        get_engine()  # Troca o engine já, liberando o modelo anterior
         info = model_loader.get_model_info()
         
         return jsonify({
@@ -322,6 +515,7 @@ if __name__ == '__main__':
     print("\nEndpoints:")
     print("  GET  /health           - Health check")
     print("  POST /api/recommender  - Get song recommendations")
+    print("  POST /api/recommender/batch - Recommendations for several song lists")
     print("  POST /reload-model     - Reload model without restart")
     print("="*70 + "\n")
     
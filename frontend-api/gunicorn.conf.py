@@ -0,0 +1,21 @@
+"""
+Configuração do Gunicorn para a API de recomendação
+"""
+
+
+def post_fork(server, worker):
+    """
+    Recarrega o modelo mais recente em cada worker recém-criado
+
+    Com --preload o modelo é carregado uma vez no processo mestre; um worker
+    reiniciado depois (timeout, crash) herdaria o modelo do boot. Se o modelo
+    não mudou, o cache de _load_pickle e o índice herdados do mestre são
+    reaproveitados sem custo.
+    """
+    from app import model_loader, get_engine
+
+    try:
+        model_loader.load_latest_model()
+        get_engine()
+    except Exception as e:
+        worker.log.warning(f"[WARNING] No model available: {e}")
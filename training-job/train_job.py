@@ -6,18 +6,22 @@ Designed to run as a Kubernetes Job (batch execution)
 """
 
 import logging
+import math
 import sys
 import os
+import numpy as np
 import pandas as pd
 import pickle
-import json
+import orjson
+import shutil
+import tempfile
 from datetime import datetime
-from collections import defaultdict
-from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from io import StringIO
 import urllib3
 
+import utils_numba
+
 # Disable SSL warnings when verify=False is used
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -33,171 +37,295 @@ logger = logging.getLogger(__name__)
 # ECLAT ALGORITHM IMPLEMENTATION
 # ============================================================================
 
+# Tabela de popcount por byte (np.bitwise_count só existe a partir do NumPy 2.0)
+_POPCOUNT_LUT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _popcount_rows(bits):
+    """Conta os bits ligados de cada linha de uma matriz de bitsets np.uint64"""
+    return _POPCOUNT_LUT[bits.view(np.uint8)].sum(axis=1, dtype=np.int64)
+
+
+def _cgroup_cpu_limit():
+    """
+    Limite de CPU do container (cota CFS do cgroup), arredondado para cima
+    
+    Returns:
+        int ou None se não houver cota (cgroup v2 ou v1)
+    """
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota == 'max':
+            return None
+        return math.ceil(int(quota) / int(period))
+    except (OSError, ValueError):
+        pass
+    
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota <= 0:
+            return None
+        return math.ceil(quota / period)
+    except (OSError, ValueError):
+        return None
+
+
+def _available_cpus():
+    """CPUs que o processo pode de fato usar: afinidade, limitada pela cota do cgroup"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, limit)
+    return max(cpus, 1)
+
+
 class EclatAlgorithm:
     """
     Implementação do algoritmo Eclat para mineração de regras de associação
-    usando representação vertical (tid-lists)
+    usando representação vertical (tid-lists como bitsets np.uint64)
+    
+    Items são codificados uma única vez como inteiros (índice em id_to_item);
+    o DFS e a geração de regras trabalham só com ids, decodificados em get_results.
     """
     
     def __init__(self):
         self.min_support = 0.05  # Hard-coded: 5%
         self.min_confidence = 0.3  # Hard-coded: 30%
-        self.frequent_itemsets = []
-        self.rules = []
-        self.tid_lists = {}
+        self.use_diffsets = True  # dEclat a partir de itemsets de tamanho 3
+        self.max_itemset_size = 5  # Limitando profundidade para performance
+        self.n_workers = _available_cpus()  # Threads para as classes de 1º nível (limite do pod)
+        self.itemsets = []  # Itemsets frequentes (tuplas de ids), em paralelo com supports
+        self.supports = np.empty(0, dtype=np.float64)
+        self.itemsets_by_len = {}  # Tamanho -> posições em itemsets
+        # Regras em arrays paralelos; a posição do itemset dá o suporte da regra
+        self.rule_antecedents = []
+        self.rule_consequents = []
+        self.rule_itemsets = []
+        self.rule_confidences = []
+        self.rule_lifts = []
+        self.id_to_item = []
+        self.bitsets = None
         self.num_transactions = 0
+        self.n_words = 0
         
-    def fit(self, transactions):
+    def fit(self, tids, item_ids, id_to_item, num_transactions):
         """
         Executa o algoritmo Eclat nas transações
         
+        As transações chegam já codificadas, uma entrada por (playlist, música):
+        
         Args:
-            transactions: Lista de listas (playlists)
-                         [["Song1,Artist1", "Song2,Artist2"], ...]
+            tids: Índice da transação (playlist) de cada entrada, 0..num_transactions-1
+            item_ids: Id do item de cada entrada (índice em id_to_item)
+            id_to_item: Lista de items ["Song1,Artist1", ...] indexada pelo id
+            num_transactions: Número de transações (playlists)
         """
-        self.num_transactions = len(transactions)
+        self.num_transactions = num_transactions
+        self.id_to_item = id_to_item
         min_sup_count = int(self.min_support * self.num_transactions)
         
         # Passo 1: Construir tid-lists (vertical database)
-        self._build_tid_lists(transactions)
+        self._build_tid_lists(tids, item_ids)
         
         # Passo 2: Filtrar items frequentes (suporte >= min_support)
-        frequent_items = {
-            item: tids 
-            for item, tids in self.tid_lists.items() 
-            if len(tids) >= min_sup_count
-        }
+        item_counts = _popcount_rows(self.bitsets)
+        frequent_ids = np.flatnonzero(item_counts >= min_sup_count)
+        
+        # Ordem de suporte crescente: os items mais raros definem as classes e
+        # as interseções encolhem (e param antecipadamente) mais rápido
+        frequent_ids = frequent_ids[np.argsort(item_counts[frequent_ids], kind='stable')]
+        frequent_counts = item_counts[frequent_ids]
         
         # Adicionar itemsets de tamanho 1 aos resultados
-        for item, tids in frequent_items.items():
-            support = len(tids) / self.num_transactions
-            self.frequent_itemsets.append({
-                'itemset': [item],
-                'support': support,
-                'tid_list': tids
-            })
-        
-        # Passo 3: Encontrar itemsets frequentes maiores (DFS)
-        items = sorted(frequent_items.keys())
-        for i, item in enumerate(items):
-            # Explorar combinações com items posteriores
-            self._eclat_recursive(
-                prefix=[item],
-                prefix_tids=frequent_items[item],
-                remaining_items=items[i+1:],
-                frequent_items=frequent_items,
-                min_sup_count=min_sup_count
-            )
+        self.itemsets.extend((item_id,) for item_id in frequent_ids.tolist())
+        self.itemsets_by_len[1] = list(range(len(frequent_ids)))
+        count_chunks = [frequent_counts]
+        
+        # Passo 3: Encontrar itemsets frequentes maiores (DFS em Numba)
+        if len(frequent_ids):
+            count_chunks.extend(self._eclat_numba(frequent_ids, frequent_counts, min_sup_count))
+        
+        # Suportes calculados de uma vez, sem um float Python por itemset
+        self.supports = np.concatenate(count_chunks) / self.num_transactions
         
         # Passo 4: Gerar regras de associação
         self._generate_rules()
         
         return self
     
-    def _build_tid_lists(self, transactions):
-        """Constrói tid-lists para cada item"""
-        self.tid_lists = defaultdict(set)
+    def _build_tid_lists(self, tids, item_ids):
+        """
+        Constrói um bitset de tids por item em uma única passada vetorizada
         
-        for tid, transaction in enumerate(transactions):
-            for item in transaction:
-                self.tid_lists[item].add(tid)
+        A linha `item_id` de self.bitsets tem o bit `tid` ligado se o item
+        aparece na transação `tid`; cada linha tem ceil(num_transactions / 64)
+        palavras.
+        """
+        self.n_words = (self.num_transactions + 63) >> 6
+        
+        ids = np.asarray(item_ids, dtype=np.intp)
+        tids = np.asarray(tids, dtype=np.uint64)
+        self.bitsets = np.zeros((len(self.id_to_item), self.n_words), dtype=np.uint64)
+        np.bitwise_or.at(
+            self.bitsets,
+            (ids, (tids >> np.uint64(6)).astype(np.intp)),
+            np.uint64(1) << (tids & np.uint64(63))
+        )
     
-    def _eclat_recursive(self, prefix, prefix_tids, remaining_items, frequent_items, min_sup_count):
+    def _eclat_numba(self, frequent_ids, frequent_counts, min_sup_count):
         """
-        DFS recursivo para encontrar itemsets frequentes
+        Executa o DFS do Eclat no kernel Numba
         
         Args:
-            prefix: Lista de items no itemset atual
-            prefix_tids: Set de transaction IDs do prefix
-            remaining_items: Items ainda não explorados
-            frequent_items: Dicionário de items frequentes
+            frequent_ids: Ids dos items frequentes, em ordem crescente de suporte
+            frequent_counts: Contagem de transações de cada item frequente
             min_sup_count: Contagem mínima de suporte
-        """
-        for i, item in enumerate(remaining_items):
-            # Intersectar tid-lists (operação chave do Eclat)
-            new_tids = prefix_tids.intersection(frequent_items[item])
             
-            # Verificar se é frequente
-            if len(new_tids) >= min_sup_count:
-                new_itemset = prefix + [item]
-                support = len(new_tids) / self.num_transactions
-                
-                # Adicionar aos itemsets frequentes
-                self.frequent_itemsets.append({
-                    'itemset': new_itemset,
-                    'support': support,
-                    'tid_list': new_tids
-                })
-                
-                # Recursão: explorar itemsets maiores
-                # Limitando profundidade para performance
-                if len(new_itemset) < 5:  # Max itemset size = 5
-                    self._eclat_recursive(
-                        prefix=new_itemset,
-                        prefix_tids=new_tids,
-                        remaining_items=remaining_items[i+1:],
-                        frequent_items=frequent_items,
-                        min_sup_count=min_sup_count
-                    )
+        Returns:
+            list: Contagens dos itemsets de cada classe (np.int64), na mesma
+                  ordem em que os itemsets foram adicionados a self.itemsets
+        """
+        ids = frequent_ids.astype(np.int32)
+        bits = np.ascontiguousarray(self.bitsets[frequent_ids])
+        counts = frequent_counts.astype(np.int64)
+        
+        # Intervalo [lo, hi) de palavras não nulas de cada bitset: o kernel não
+        # visita as regiões vazias (items concentrados em poucas playlists)
+        nonzero = bits != 0
+        lo = nonzero.argmax(axis=1).astype(np.int64)
+        hi = (self.n_words - nonzero[:, ::-1].argmax(axis=1)).astype(np.int64)
+        
+        def mine(i):
+            return utils_numba.mine_class(
+                i, ids, bits, lo, hi, counts, min_sup_count,
+                self.max_itemset_size, self.use_diffsets
+            )
+        
+        # Locais em vez de atributos no loop de decodificação
+        itemsets_extend = self.itemsets.extend
+        by_len = self.itemsets_by_len
+        count_chunks = []
+        
+        # Classes de 1º nível são independentes: uma tarefa por item, resultados em ordem
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            for flat, lens, class_counts in executor.map(mine, range(len(ids))):
+                flat = flat.tolist()
+                ends = np.cumsum(lens).tolist()
+                starts = [0] + ends[:-1]
+                base = len(self.itemsets)
+                for pos, length in enumerate(lens.tolist(), base):
+                    by_len.setdefault(length, []).append(pos)
+                itemsets_extend([tuple(flat[a:b]) for a, b in zip(starts, ends)])
+                count_chunks.append(class_counts)
+        
+        return count_chunks
     
     def _generate_rules(self):
         """Gera regras de associação a partir dos itemsets frequentes"""
-        self.rules = []
-        
-        # Criar dicionário para lookup rápido de suporte
-        itemset_support = {}
-        for fs in self.frequent_itemsets:
-            key = frozenset(fs['itemset'])
-            itemset_support[key] = fs['support']
-        
-        # Gerar regras de itemsets com tamanho >= 2
-        for fs in self.frequent_itemsets:
-            itemset = fs['itemset']
-            if len(itemset) < 2:
+        antecedents = []
+        consequents = []
+        rule_itemsets = []
+        confidences = []
+        lifts = []
+        
+        # Criar dicionário para lookup rápido de suporte. Itemsets saem do DFS
+        # com os ids sempre na mesma ordem global (suporte crescente), assim
+        # como as partições abaixo: a tupla já é a chave canônica, sem frozensets
+        supports = self.supports.tolist()
+        itemset_support = dict(zip(self.itemsets, supports))
+        
+        # Locais em vez de atributos/métodos dentro do loop de partições
+        support_get = itemset_support.get
+        antecedents_append = antecedents.append
+        consequents_append = consequents.append
+        rule_itemsets_append = rule_itemsets.append
+        confidences_append = confidences.append
+        lifts_append = lifts.append
+        min_confidence = self.min_confidence
+        
+        # Gerar regras de itemsets com tamanho >= 2, direto pelo índice por tamanho
+        itemsets = self.itemsets
+        for k in sorted(self.itemsets_by_len):
+            if k < 2:
                 continue
             
-            itemset_sup = fs['support']
+            # Partições não-vazias (antecedent => consequent) como posições no
+            # itemset, calculadas uma vez por tamanho: o bit j da máscara indica
+            # se itemset[j] vai para o antecedent
+            partitions = [
+                (tuple([j for j in range(k) if mask >> j & 1]),
+                 tuple([j for j in range(k) if not mask >> j & 1]))
+                for mask in range(1, (1 << k) - 1)
+            ]
             
-            # Gerar todas as partições não-vazias (antecedent => consequent)
-            for i in range(1, len(itemset)):
-                for antecedent in combinations(itemset, i):
-                    antecedent = list(antecedent)
-                    consequent = [item for item in itemset if item not in antecedent]
+            for pos in self.itemsets_by_len[k]:
+                itemset = itemsets[pos]
+                itemset_sup = supports[pos]
+                
+                for antecedent_idx, consequent_idx in partitions:
+                    antecedent = tuple([itemset[j] for j in antecedent_idx])
+                    
+                    # Filtrar por min_confidence na forma multiplicativa: a
+                    # divisão só é feita para as regras aceitas
+                    antecedent_sup = support_get(antecedent)
+                    if antecedent_sup is None or itemset_sup < min_confidence * antecedent_sup:
+                        continue
                     
-                    # Calcular confidence
-                    antecedent_key = frozenset(antecedent)
-                    if antecedent_key in itemset_support:
-                        antecedent_sup = itemset_support[antecedent_key]
-                        confidence = itemset_sup / antecedent_sup
-                        
-                        # Filtrar por min_confidence
-                        if confidence >= self.min_confidence:
-                            # Calcular lift
-                            consequent_key = frozenset(consequent)
-                            consequent_sup = itemset_support.get(consequent_key, 0.0001)
-                            lift = confidence / consequent_sup
-                            
-                            self.rules.append({
-                                'antecedent': antecedent,
-                                'consequent': consequent,
-                                'support': itemset_sup,
-                                'confidence': confidence,
-                                'lift': lift
-                            })
+                    # Calcular confidence e lift
+                    consequent = tuple([itemset[j] for j in consequent_idx])
+                    confidence = itemset_sup / antecedent_sup
+                    consequent_sup = support_get(consequent, 0.0001)
+                    lift = confidence / consequent_sup
+                    
+                    antecedents_append(antecedent)
+                    consequents_append(consequent)
+                    rule_itemsets_append(pos)
+                    confidences_append(confidence)
+                    lifts_append(lift)
+        
+        self.rule_antecedents = antecedents
+        self.rule_consequents = consequents
+        self.rule_itemsets = np.array(rule_itemsets, dtype=np.int64)
+        self.rule_confidences = np.array(confidences, dtype=np.float64)
+        self.rule_lifts = np.array(lifts, dtype=np.float64)
     
     def get_results(self):
-        """Retorna dicionário com regras e métricas"""
+        """Retorna dicionário com regras e métricas (items decodificados)"""
+        id_to_item = self.id_to_item
         return {
             'frequent_itemsets': [
                 {
-                    'itemset': fs['itemset'],
-                    'support': fs['support']
+                    'itemset': [id_to_item[i] for i in itemset],
+                    'support': support
+                }
+                for itemset, support in zip(self.itemsets, self.supports.tolist())
+            ],
+            'rules': [
+                {
+                    'antecedent': [id_to_item[i] for i in antecedent],
+                    'consequent': [id_to_item[i] for i in consequent],
+                    'support': support,
+                    'confidence': confidence,
+                    'lift': lift
                 }
-                for fs in self.frequent_itemsets
+                for antecedent, consequent, support, confidence, lift in zip(
+                    self.rule_antecedents,
+                    self.rule_consequents,
+                    self.supports[self.rule_itemsets].tolist(),
+                    self.rule_confidences.tolist(),
+                    self.rule_lifts.tolist()
+                )
             ],
-            'rules': self.rules,
-            'num_rules': len(self.rules),
-            'num_itemsets': len(self.frequent_itemsets)
+            'num_rules': len(self.rule_antecedents),
+            'num_itemsets': len(self.itemsets)
         }
 
 
@@ -225,8 +353,12 @@ class ModelManager:
             'current_version': '0.0',
             'models': {}
         }
-        with open(self.metadata_file, 'w') as f:
-            json.dump(metadata, f, indent=2)
+        self._write_metadata(metadata)
+    
+    def _write_metadata(self, metadata):
+        """Grava metadata.json (orjson, indentado com 2 espaços)"""
+        with open(self.metadata_file, 'wb') as f:
+            f.write(orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
     
     def get_next_version(self):
         """Retorna próxima versão (1.0, 2.0, 3.0, ...)"""
@@ -241,9 +373,10 @@ class ModelManager:
         timestamp = datetime.now().isoformat()
         model_path = os.path.join(self.models_dir, f'association_rules_v{version}.pkl')
         
-        # Salvar pickle
+        # Salvar pickle (protocolo 5). Ainda sem zstd: frontends antigos só leem
+        # .pkl; o frontend atual já lê .pkl.zst e .pkl
         with open(model_path, 'wb') as f:
-            pickle.dump(model_data, f)
+            pickle.dump(model_data, f, protocol=pickle.HIGHEST_PROTOCOL)
         
         # Atualizar metadata
         metadata = self.get_metadata()
@@ -255,16 +388,15 @@ class ModelManager:
             'num_itemsets': num_itemsets
         }
         
-        with open(self.metadata_file, 'w') as f:
-            json.dump(metadata, f, indent=2)
+        self._write_metadata(metadata)
         
         return model_path, version, timestamp
     
     def get_metadata(self):
         """Retorna metadata atual"""
         if os.path.exists(self.metadata_file):
-            with open(self.metadata_file, 'r') as f:
-                return json.load(f)
+            with open(self.metadata_file, 'rb') as f:
+                return orjson.loads(f.read())
         return {'current_version': '0.0', 'models': {}}
 
 
@@ -274,46 +406,71 @@ class ModelManager:
 
 def download_and_process_dataset(dataset_url):
     """
-    Baixa CSV da URL e processa em playlists
+    Baixa CSV da URL e codifica as playlists como inteiros
     
     Args:
         dataset_url: URL do CSV
         
     Returns:
-        tuple: (playlists, total_transactions, total_playlists, unique_items)
+        tuple: (tids, item_ids, id_to_item, total_transactions,
+                total_playlists, unique_items), onde tids/item_ids são
+                arrays com a playlist e o item de cada linha do CSV
     """
     try:
-        # Download do CSV
+        # Download do CSV em streaming para um arquivo temporário (comprimido em trânsito)
         logger.info(f"Downloading dataset from: {dataset_url}")
-        response = requests.get(dataset_url, timeout=300, verify=False)
-        response.raise_for_status()
-        
-        # Ler CSV
-        logger.info("Parsing CSV...")
-        csv_data = StringIO(response.text)
-        df = pd.read_csv(csv_data)
+        required_cols = ['pid', 'track_name', 'artist_name']
+        with tempfile.NamedTemporaryFile(suffix='.csv') as csv_file:
+            # Timeout de conexão curto (falha rápido se o host não responde) e de leitura longo
+            with requests.get(dataset_url, timeout=(10, 300), verify=False, stream=True,
+                              headers={'Accept-Encoding': 'gzip'}) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                shutil.copyfileobj(response.raw, csv_file, length=1 << 20)
+            csv_file.flush()
+            
+            # Ler CSV do disco (conexão já liberada), só as colunas usadas;
+            # track/artist como category (cada nome distinto vira uma string só)
+            logger.info("Parsing CSV...")
+            df = pd.read_csv(
+                csv_file.name,
+                usecols=lambda col: col in required_cols,
+                dtype={'track_name': 'category', 'artist_name': 'category'}
+            )
         
         # Validar colunas necessárias
-        required_cols = ['pid', 'track_name', 'artist_name']
         if not all(col in df.columns for col in required_cols):
             raise ValueError(f"CSV deve conter colunas: {required_cols}")
         
         logger.info(f"Dataset loaded: {len(df)} rows")
         
-        # Criar chave única "track_name,artist_name"
-        df['item'] = df['track_name'] + ',' + df['artist_name']
-        
-        # Agrupar por playlist
-        logger.info("Grouping by playlist...")
-        playlists = df.groupby('pid')['item'].apply(list).tolist()
+        # Codificar playlists e items como inteiros (ids em ordem de pid / alfabética).
+        # O item é o par (track_name, artist_name): as duas colunas são codificadas
+        # separadamente e combinadas em um único código inteiro, sem concatenar strings
+        logger.info("Encoding playlists and items...")
+        tids, pids = pd.factorize(df['pid'], sort=True)
+        track_codes, tracks = pd.factorize(df['track_name'], sort=True)
+        artist_codes, artists = pd.factorize(df['artist_name'], sort=True)
+        
+        # Linhas sem pid, track ou artist recebem código -1
+        valid = (tids >= 0) & (track_codes >= 0) & (artist_codes >= 0)
+        tids = tids[valid]
+        n_artists = max(len(artists), 1)
+        pair_codes = track_codes[valid].astype(np.int64) * n_artists + artist_codes[valid]
+        item_ids, pairs = pd.factorize(pair_codes, sort=True)
+        
+        # Chave "track_name,artist_name" só para os items distintos
+        tracks = np.asarray(tracks, dtype=object)[pairs // n_artists]
+        artists = np.asarray(artists, dtype=object)[pairs % n_artists]
+        items = [f"{track},{artist}" for track, artist in zip(tracks, artists)]
         
         total_transactions = len(df)
-        total_playlists = len(playlists)
-        unique_items = df['item'].nunique()
+        total_playlists = len(pids)
+        unique_items = len(items)
         
         logger.info(f"Processed: {total_playlists} playlists, {unique_items} unique songs")
         
-        return playlists, total_transactions, total_playlists, unique_items
+        return tids, item_ids, items, total_transactions, total_playlists, unique_items
         
     except requests.exceptions.RequestException as e:
         raise Exception(f"Erro ao baixar dataset: {str(e)}")
@@ -351,7 +508,7 @@ def train_and_save_model():
         
         # Step 1: Download and process dataset
         logger.info("Step 1/3: Downloading and processing dataset...")
-        playlists, total_trans, total_playlists, unique_items = \
+        tids, item_ids, id_to_item, total_trans, total_playlists, unique_items = \
             download_and_process_dataset(dataset_url)
         
         logger.info(f"Dataset stats: {total_playlists} playlists, {unique_items} unique items, {total_trans} transactions")
@@ -359,7 +516,7 @@ def train_and_save_model():
         # Step 2: Train Eclat algorithm
         logger.info("Step 2/3: Training Eclat algorithm...")
         eclat = EclatAlgorithm()
-        eclat.fit(playlists)
+        eclat.fit(tids, item_ids, id_to_item, total_playlists)
         results = eclat.get_results()
         
         logger.info(f"Training completed: {results['num_itemsets']} itemsets, {results['num_rules']} rules generated")
@@ -0,0 +1,238 @@
+"""
+Numba kernels for the Eclat training job
+Bitset intersection/diff and the equivalence-class DFS run as native code,
+one first-level equivalence class per call (GIL released)
+"""
+
+import numpy as np
+from numba import njit, types
+from numba.typed import List
+
+
+_ZERO = np.uint64(0)
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+
+
+@njit(cache=True)
+def popcount64(x):
+    """Popcount SWAR de uma palavra np.uint64"""
+    x = x - ((x >> np.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return np.int64((x * _H01) >> np.uint64(56))
+
+
+@njit(cache=True)
+def diff_es(a, a_lo, a_hi, b, b_lo, b_hi, budget, out):
+    """
+    Escreve `a & ~b` em out[a_lo:a_hi] com parada antecipada (INTERSECT_ES)
+
+    Cada bitset só é lido dentro do seu intervalo de palavras não nulas
+    [lo, hi); fora de [b_lo, b_hi) a palavra de `b` vale zero.
+
+    Returns:
+        Bits de `a` descartados, ou -1 assim que o descarte passa de `budget`
+    """
+    discarded = 0
+    for w in range(a_lo, a_hi):
+        d = a[w]
+        if w >= b_lo and w < b_hi:
+            d = d & ~b[w]
+        out[w] = d
+        discarded += popcount64(d)
+        if discarded > budget:
+            return -1
+    return discarded
+
+
+@njit(cache=True)
+def diff_count_es(a, a_lo, a_hi, b, b_lo, b_hi, budget):
+    """
+    Igual a diff_es, mas só conta os bits descartados, sem escrever `a & ~b`
+
+    Usado no último nível do DFS, onde o bitset do filho nunca é lido.
+    """
+    discarded = 0
+    for w in range(a_lo, a_hi):
+        d = a[w]
+        if w >= b_lo and w < b_hi:
+            d = d & ~b[w]
+        discarded += popcount64(d)
+        if discarded > budget:
+            return -1
+    return discarded
+
+
+@njit(cache=True)
+def _trim(bits, lo, hi):
+    """Reduz [lo, hi) ao intervalo de palavras não nulas de `bits`"""
+    while lo < hi and bits[lo] == _ZERO:
+        lo += 1
+    while hi > lo and bits[hi - 1] == _ZERO:
+        hi -= 1
+    return lo, hi
+
+
+@njit(cache=True)
+def _build_children(member_items, member_bits, member_lo, member_hi, member_counts,
+                    n_members, i, is_diff, child_is_diff, count_only, min_sup_count,
+                    child_items, child_bits, child_lo, child_hi, child_counts):
+    """
+    Estende o membro `i` de uma classe com os membros posteriores
+
+    Os membros são P + [member_items[k]]; `member_bits` guarda seus tidsets,
+    ou seus diffsets em relação a P quando `is_diff`, válidos no intervalo
+    de palavras [member_lo, member_hi). As extensões frequentes de
+    P + [member_items[i]] são escritas em child_* (tidsets ou diffsets
+    conforme `child_is_diff`). Com `count_only` (filhos no tamanho máximo,
+    que não serão estendidos) só items e contagens são preenchidos.
+
+    Returns:
+        Número de extensões frequentes
+    """
+    count = member_counts[i]
+    budget = count - min_sup_count
+    i_lo = member_lo[i]
+    i_hi = member_hi[i]
+
+    n_child = 0
+    for j in range(i + 1, n_members):
+        if count_only:
+            if is_diff:
+                discarded = diff_count_es(member_bits[j], member_lo[j], member_hi[j],
+                                          member_bits[i], i_lo, i_hi, budget)
+            else:
+                discarded = diff_count_es(member_bits[i], i_lo, i_hi, member_bits[j],
+                                          member_lo[j], member_hi[j], budget)
+            if discarded >= 0:
+                child_items[n_child] = member_items[j]
+                child_counts[n_child] = count - discarded
+                n_child += 1
+            continue
+
+        out = child_bits[n_child]
+        if is_diff:
+            # diff(Pxy) = diff(Py) \ diff(Px)
+            lo = member_lo[j]
+            hi = member_hi[j]
+            discarded = diff_es(member_bits[j], lo, hi, member_bits[i], i_lo, i_hi, budget, out)
+        else:
+            # T(Px) \ T(Py)
+            lo = i_lo
+            hi = i_hi
+            discarded = diff_es(member_bits[i], lo, hi, member_bits[j],
+                                member_lo[j], member_hi[j], budget, out)
+        if discarded < 0:
+            continue
+
+        if not child_is_diff:
+            # T(Pxy) = T(Px) ^ (T(Px) \ T(Py))
+            for w in range(lo, hi):
+                out[w] = member_bits[i, w] ^ out[w]
+
+        child_items[n_child] = member_items[j]
+        lo, hi = _trim(out, lo, hi)
+        child_lo[n_child] = lo
+        child_hi[n_child] = hi
+        child_counts[n_child] = count - discarded
+        n_child += 1
+
+    return n_child
+
+
+@njit(cache=True)
+def _to_array(values):
+    """Copia uma typed list para um np.ndarray int64"""
+    out = np.empty(len(values), np.int64)
+    for k in range(len(values)):
+        out[k] = values[k]
+    return out
+
+
+@njit(cache=True, nogil=True)
+def mine_class(i, items, bits, lo, hi, counts, min_sup_count, max_len, use_diffsets):
+    """
+    Minera os itemsets frequentes de tamanho 2..max_len que começam no item i
+
+    As classes de 1º nível são independentes; sem o GIL, cada uma pode
+    rodar em uma thread diferente.
+
+    Args:
+        i: Posição do item que define a classe
+        items: Índices dos items frequentes (np.int32)
+        bits: Matriz (n_items, n_words) np.uint64 com os tidsets dos items frequentes
+        lo, hi: Intervalo [lo, hi) de palavras não nulas de cada tidset (np.int64)
+        counts: Contagem de transações de cada item (np.int64)
+        min_sup_count: Contagem mínima de suporte
+        max_len: Tamanho máximo dos itemsets
+        use_diffsets: Usar diffsets a partir de itemsets de tamanho 3
+
+    Returns:
+        tuple: (índices dos items de cada itemset concatenados,
+                tamanho de cada itemset, contagem de cada itemset)
+    """
+    n_items, n_words = bits.shape
+    out_items = List.empty_list(types.int32)
+    out_lens = List.empty_list(types.int64)
+    out_counts = List.empty_list(types.int64)
+
+    if max_len < 2:
+        return _to_array(out_items), _to_array(out_lens), _to_array(out_counts)
+
+    # Pilha explícita: no nível d (1..max_len-1) fica a classe de equivalência
+    # cujos membros são prefix[:d] + [item] (itemsets de tamanho d + 1), na
+    # posição d - 1 dos buffers. O nível 0 é a própria entrada (items, bits,
+    # counts) e não ocupa buffer; os buffers são alocados uma vez.
+    n_levels = max_len - 1
+    stack_items = np.empty((n_levels, n_items), np.int32)
+    stack_bits = np.empty((n_levels, n_items, n_words), np.uint64)
+    stack_lo = np.empty((n_levels, n_items), np.int64)
+    stack_hi = np.empty((n_levels, n_items), np.int64)
+    stack_counts = np.empty((n_levels, n_items), np.int64)
+    stack_size = np.zeros(n_levels, np.int64)
+    stack_next = np.zeros(n_levels, np.int64)
+    prefix = np.empty(max_len, np.int32)
+
+    prefix[0] = items[i]
+
+    # Pares (nível 1) sempre guardam tidsets
+    stack_size[0] = _build_children(
+        items, bits, lo, hi, counts, n_items, i,
+        False, False, max_len == 2, min_sup_count,
+        stack_items[0], stack_bits[0], stack_lo[0], stack_hi[0], stack_counts[0]
+    )
+    depth = 1
+    while depth >= 1:
+        level = depth - 1
+        c = stack_next[level]
+        if c >= stack_size[level]:
+            depth -= 1
+            continue
+        stack_next[level] = c + 1
+
+        prefix[depth] = stack_items[level, c]
+        for k in range(depth + 1):
+            out_items.append(prefix[k])
+        out_lens.append(depth + 1)
+        out_counts.append(stack_counts[level, c])
+
+        if depth + 1 < max_len:
+            # A partir de itemsets de tamanho 3 os membros guardam diffsets (dEclat);
+            # filhos de tamanho max_len não são estendidos: só a contagem importa
+            n_child = _build_children(
+                stack_items[level], stack_bits[level], stack_lo[level], stack_hi[level],
+                stack_counts[level], stack_size[level], c,
+                use_diffsets and depth + 1 >= 3, use_diffsets and depth + 2 >= 3,
+                depth + 2 == max_len, min_sup_count,
+                stack_items[level + 1], stack_bits[level + 1], stack_lo[level + 1],
+                stack_hi[level + 1], stack_counts[level + 1]
+            )
+            if n_child > 0:
+                depth += 1
+                stack_size[level + 1] = n_child
+                stack_next[level + 1] = 0
+
+    return _to_array(out_items), _to_array(out_lens), _to_array(out_counts)